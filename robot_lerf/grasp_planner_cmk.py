@@ -467,16 +467,20 @@ class UR5GraspPlanner:
             )
 
         # Rotate the last two joints to the pregrasp position, then rotate the first four joints to the pregrasp position.
-        traj_last_three_joints = traj.copy()
-        traj_last_three_joints[:, :3] = cur_q[:3]
-        traj_first_three_joints = traj.copy()
-        traj_first_three_joints[:, 3:] = traj_last_three_joints[-1, 3:]
-
-        traj_remaining, succ, _ = self._create_traj(traj_first_three_joints[-1], grasp_pose, world_pointcloud, allow_180=False)
+        # Both stages end at the pregrasp configuration, traj[-1].
+        traj_remaining, succ, _ = self._create_traj(traj[-1], grasp_pose, world_pointcloud, allow_180=False)
         if not succ or True in np.isnan(grasp_pose.rotation):
             return None, False, None
-        traj = np.concatenate([traj_last_three_joints, traj_first_three_joints, traj_remaining], axis=0)
-        return traj, succ, grasp_pose
+
+        # The three stages are written into one preallocated trajectory, instead of copied and concatenated
+        n_steps = len(traj)
+        full_traj = np.empty((2*n_steps + len(traj_remaining), traj.shape[1]))
+        full_traj[:n_steps, :3] = cur_q[:3]
+        full_traj[:n_steps, 3:] = traj[:, 3:]
+        full_traj[n_steps:2*n_steps, :3] = traj[:, :3]
+        full_traj[n_steps:2*n_steps, 3:] = traj[-1, 3:]
+        full_traj[2*n_steps:] = traj_remaining
+        return full_traj, succ, grasp_pose
 
 
     def create_traj_lift_up(self, cur_q: np.ndarray, cur_pose: RigidTransform, world_up_dist: float, world_pointcloud: tr.PointCloud) -> Tuple[Any, Any]:
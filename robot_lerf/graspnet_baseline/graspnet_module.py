@@ -2,12 +2,13 @@ import os
 import sys
 
 import trimesh as tr
-import open3d as o3d
 
-from typing import List
+from typing import List, Tuple, Union
+import functools
 import time
 
 import numpy as np
+from scipy.spatial import cKDTree
 import torch
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
@@ -20,8 +21,83 @@ from graspnetAPI import GraspGroup, Grasp
 from graspnet import GraspNet, pred_decode
 from collision_detector import ModelFreeCollisionDetector
 
+
+@functools.lru_cache(maxsize=256)
+def get_gripper_mesh(depth: float, width: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Gripper mesh in the grasp frame, cached since it only depends on the grasp depth and width.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: vertices and faces of the mesh
+    """
+    gripper = Grasp()
+    gripper.depth = depth
+    gripper.width = width
+    gripper = gripper.to_open3d_geometry()
+    return np.asarray(gripper.vertices), np.asarray(gripper.triangles)
+
+
+def get_bboxes_from_grasps(grasp_array: Union[np.ndarray, torch.Tensor]):
+    """Bounding boxes of grasps, as arrays. The box of a grasp is centered on its translation,
+    oriented by its rotation, and spans its (depth, width, height).
+    Only slices `grasp_array`, so the boxes stay on whatever device/dtype the array is on.
+
+    Args:
+        grasp_array (np.ndarray or torch.Tensor): GraspGroup.grasp_group_array, (G, 17)
+
+    Returns:
+        Tuple of np.ndarray or torch.Tensor:
+         - centers: box centers, (G, 3)
+         - rotations: box orientations, (G, 3, 3)
+         - half_extents: half of the (depth, width, height) box extents, (G, 3)
+    """
+    # graspnetAPI layout: [score, width, height, depth, rotation (9), translation (3), object_id]
+    half_extents = grasp_array[:, [3, 1, 2]] / 2
+    return grasp_array[:, 13:16], grasp_array[:, 4:13].reshape(-1, 3, 3), half_extents
+
+
+def get_points_in_bboxes(
+    points: torch.Tensor,
+    centers: torch.Tensor,
+    rotations: torch.Tensor,
+    half_extents: torch.Tensor,
+) -> torch.Tensor:
+    """Point-in-oriented-box test for every (box, point) pair.
+
+    Args:
+        points (torch.Tensor): points, (N, 3)
+        centers, rotations, half_extents (torch.Tensor): boxes, see `get_bboxes_from_grasps`
+
+    Returns:
+        torch.Tensor: boolean inclusion mask, (G, N)
+    """
+    # points in the local frame of each box
+    local = torch.einsum('gji,gpj->gpi', rotations, points[None] - centers[:, None])
+    return (local.abs() <= half_extents[:, None]).all(dim=-1)
+
+
+def get_masked_median(values: torch.Tensor, mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Per-row median of `values` over the True entries of `mask`, same as np.median(values[mask[g]]).
+
+    Args:
+        values (torch.Tensor): values, (N,)
+        mask (torch.Tensor): boolean mask, (G, N)
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]:
+         - median: median per row, 0 for rows with no True entries, (G,)
+         - count: number of True entries per row, (G,)
+    """
+    # NaNs sort last, so the median of the k valid values sits at (k-1)//2 and k//2
+    vals = values.expand_as(mask).masked_fill(~mask, float('nan')).sort(dim=1).values
+    count = mask.sum(dim=1, keepdim=True)
+    median = (vals.gather(1, (count-1).clamp(min=0)//2) + vals.gather(1, count//2)).squeeze(1) / 2
+    count = count.squeeze(1)
+    return torch.where(count > 0, median, torch.zeros_like(median)), count
+
+
 class GraspNetModule:
     num_point_in_pc: int = 100000
+    _points_buffer: torch.Tensor = None
 
     def init_net(self, ckpt_path, global_pointcloud, cylinder_radius=0.03, floor_height=-0.17):
         # Init the model
@@ -46,26 +122,42 @@ class GraspNetModule:
         self.pointcloud_vertices = global_pointcloud.vertices.copy()
         self.pointcloud_vertices = self.pointcloud_vertices[self.pointcloud_vertices[:, 2] > self.floor_height+0.01]
         self.mfcdetector = ModelFreeCollisionDetector(self.pointcloud_vertices, voxel_size=0.005)
-
-    def __call__(self, pointcloud_list: List[tr.Trimesh]) -> List[GraspGroup]:
-        points_list = []
-        for pointcloud in pointcloud_list:
-            points = pointcloud.vertices
-
+        self.pointcloud_kdtree = cKDTree(self.pointcloud_vertices)
+
+    def __call__(self, pointclouds: Union[List[tr.Trimesh], np.ndarray]) -> List[GraspGroup]:
+        """Predict grasps for a batch of pointclouds, each given in its camera frame.
+
+        Args:
+            pointclouds (Union[List[tr.Trimesh], np.ndarray]): list of pointclouds,
+                or the stacked points of same-sized pointclouds, (B, N, 3)
+
+        Returns:
+            List[GraspGroup]: grasps per pointcloud, in the camera frame
+        """
+        if isinstance(pointclouds, list):
+            pointclouds = [pointcloud.vertices for pointcloud in pointclouds]
+
+        # Subsample every pointcloud into one (pinned) host buffer, then copy the batch at once
+        batch_size = len(pointclouds)
+        if self._points_buffer is None or self._points_buffer.shape[0] < batch_size:
+            self._points_buffer = torch.empty(
+                (batch_size, self.num_point_in_pc, 3),
+                dtype=torch.float32,
+                pin_memory=(device.type == "cuda")
+            )
+        points_batch = self._points_buffer[:batch_size]
+        for i, points in enumerate(pointclouds):
             if len(points) >= self.num_point_in_pc:
                 idxs = np.random.choice(len(points), self.num_point_in_pc, replace=False)
             else:
                 idxs1 = np.arange(len(points))
                 idxs2 = np.random.choice(len(points), self.num_point_in_pc-len(points), replace=True)
                 idxs = np.concatenate([idxs1, idxs2], axis=0)
-            points = points[idxs]
+            points_batch[i].numpy()[:] = points[idxs]
 
         # convert data
-            end_points = dict()
-            points = torch.from_numpy(points[np.newaxis].astype(np.float32)).to(device)
-            points_list.append(points)
-
-        end_points['point_clouds'] = torch.cat(points_list, dim=0)
+        end_points = dict()
+        end_points['point_clouds'] = points_batch.to(device, non_blocking=True)
         gg_list = self._get_grasps(end_points)
         return gg_list
 
@@ -80,16 +172,37 @@ class GraspNetModule:
             grasp_list.append(GraspGroup(grasp_preds[i].detach().cpu().numpy()))
         return grasp_list
 
-    @staticmethod
-    def get_bbox_from_grasp(gg: Grasp):
-        center = gg.translation
-        R = gg.rotation_matrix
-        H= np.eye(4)
-        H[:3,:3] = R
-        H[:3,3] = center
-        extent=np.array((gg.depth,gg.width,gg.height))
-        box = o3d.geometry.OrientedBoundingBox(center,H[:3,:3],extent)
-        return box
+    def count_points_in_grasps(self, gg: GraspGroup, chunk_size: int = 64) -> np.ndarray:
+        """Count the pointcloud vertices inside each grasp's bounding box (see `get_bboxes_from_grasps`).
+        Only the vertices within a box's circumradius of its center, found with a KD-tree query,
+        go through the oriented box test.
+
+        Args:
+            gg (GraspGroup): grasps
+            chunk_size (int): number of grasps queried and tested at once, bounds the (grasp, vertex) pair buffers
+
+        Returns:
+            np.ndarray: number of vertices inside each grasp box, (G,)
+        """
+        counts = np.zeros(len(gg), dtype=int)
+        centers, rotations, half_extents = get_bboxes_from_grasps(gg.grasp_group_array)
+        radii = np.linalg.norm(half_extents, axis=1) + 1e-6
+        for i in range(0, len(gg), chunk_size):
+            chunk_centers, chunk_rotations, chunk_half_extents = centers[i:i+chunk_size], rotations[i:i+chunk_size], half_extents[i:i+chunk_size]
+            neighbors = self.pointcloud_kdtree.query_ball_point(chunk_centers, radii[i:i+chunk_size], workers=-1)
+            # (grasp, vertex) candidate pairs of this chunk, grasp indices local to the chunk
+            grasp_inds = np.repeat(np.arange(len(chunk_centers)), [len(n) for n in neighbors])
+            if len(grasp_inds) == 0:
+                continue
+            point_inds = np.concatenate(neighbors).astype(int)
+            local = np.einsum(
+                'nji,nj->ni',
+                chunk_rotations[grasp_inds],
+                self.pointcloud_vertices[point_inds] - chunk_centers[grasp_inds]
+            )
+            inside = (np.abs(local) <= chunk_half_extents[grasp_inds]).all(axis=1)
+            counts[i:i+chunk_size] = np.bincount(grasp_inds[inside], minlength=len(chunk_centers))
+        return counts
 
     def local_collision_detection(self, gg):
         start = time.time()
@@ -107,13 +220,7 @@ class GraspNetModule:
         # collision_with_ground_mask = (gg.translations + gg.rotation_matrices[:, 0]*gg.depths[:, None])[:, 2] < self.floor_height
 
         start = time.time()
-        no_includes_pc = []
-        verts_o3d = o3d.utility.Vector3dVector(self.pointcloud_vertices)
-        for grasp in gg:
-            bbox = self.get_bbox_from_grasp(grasp)
-            no_includes_coll_pointcloud = (len(bbox.get_point_indices_within_bounding_box(verts_o3d)) <= 10)
-            no_includes_pc.append(no_includes_coll_pointcloud)
-        no_includes_pc = np.stack(no_includes_pc, axis=0)
+        no_includes_pc = self.count_points_in_grasps(gg) <= 10
         collision_mask = collision_mask | no_includes_pc
         print('collision with pc time: ', time.time()-start, 'remaining', len(gg) - sum(collision_mask))
 
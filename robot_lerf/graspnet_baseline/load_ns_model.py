@@ -277,7 +277,7 @@ class NerfstudioWrapper:
         return mask
     
     # Main function to get generate the lerf point cloud for the object part
-    def get_lerf_pointcloud(self, curcam, render_lerf=True) -> Tuple[o3d.geometry.PointCloud, np.ndarray]:
+    def get_lerf_pointcloud(self, curcam, render_lerf=True) -> Tuple[o3d.geometry.PointCloud, torch.Tensor]:
         if render_lerf:
             self.pipeline.model.step = 1000
         else:
@@ -359,7 +359,7 @@ class NerfstudioWrapper:
         relevancies = relevancies - relevancies.min()
         relevancies = relevancies / relevancies.max()
         relevancies = relevancies[ind]
-        return pcd, relevancies.cpu().numpy(), dino_pcd, target_points, _
+        return pcd, relevancies, dino_pcd, target_points, _
 
     def create_pointcloud(self) -> Tuple[tr.PointCloud, np.ndarray]:
         self.pipeline.model.step = 0
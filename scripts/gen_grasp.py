@@ -5,10 +5,12 @@ import tyro
 
 import os
 import os.path as osp
+import weakref
 from pathlib import Path
-import open3d as o3d
 import matplotlib
 from typing import List, Dict, Tuple
+from scipy.spatial import cKDTree
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -22,10 +24,37 @@ from graspnetAPI import GraspGroup, Grasp
 from nerfstudio.pipelines.base_pipeline import Pipeline
 
 from robot_lerf.graspnet_baseline.load_ns_model import NerfstudioWrapper, RealsenseCamera, MyCamera
-from robot_lerf.graspnet_baseline.graspnet_module import GraspNetModule
+from robot_lerf.graspnet_baseline.graspnet_module import (
+    GraspNetModule, get_gripper_mesh, get_bboxes_from_grasps, get_points_in_bboxes, get_masked_median
+)
 from robot_lerf.capture_utils import _generate_hemi
 from robot_lerf.grasp_planner_cmk import UR5GraspPlanner
 
+GRASP_COLORMAP = matplotlib.colormaps['RdYlGn']
+# viridis sampled at its 256 entries; indexing with floor(256 * x) matches calling the colormap on x in [0, 1]
+RELEVANCY_COLOR_LUT = matplotlib.colormaps['viridis'](np.arange(256))[:, :3].astype(np.float32)
+# [UR5 frame (EE)] to [Grasp frame (graspnetAPI)] rotation, as wxyz
+UR5_FRAME_WXYZ = RigidTransform(
+    rotation=RigidTransform.y_axis_rotation(np.pi/2) @ RigidTransform.z_axis_rotation(np.pi/2)
+).quaternion
+# Viser-frame camera pose the LERF pointcloud is queried from, fixed for the table setup
+CENTER_POS_MATRIX = np.array([[ 1., 0., 0., 0.45], [0., -0.70710678,  0.70710678, -0.28284271],[ 0, -0.70710678, -0.70710678,  0.10284271]])
+# NerfstudioWrapper -> query camera, entries go away with their scene
+_relevancy_cameras = weakref.WeakKeyDictionary()
+
+def affine_transform(pts: np.ndarray, T: np.ndarray) -> np.ndarray:
+    """Apply a rigid/affine transform to points, skipping the homogeneous row.
+
+    Works on both np.ndarray and torch.Tensor inputs.
+
+    Args:
+        pts (np.ndarray): points, (N, 3)
+        T (np.ndarray): transform(s), (4, 4) / (3, 4), or stacked as (B, 4, 4)
+
+    Returns:
+        np.ndarray: transformed points, (N, 3) or (B, N, 3) for stacked transforms
+    """
+    return pts @ T[..., :3, :3].swapaxes(-1, -2) + T[..., None, :3, 3]
 
 def get_relevancy_pointcloud(ns_wrapper: NerfstudioWrapper, **kwargs):
     """Get relevancy pointcloud, used to get semantic score
@@ -34,29 +63,73 @@ def get_relevancy_pointcloud(ns_wrapper: NerfstudioWrapper, **kwargs):
         ns_wrapper (NerfstudioWrapper): nerf scene
 
     Returns:
-        o3d.utility.Vector3DVector: points in pointcloud (xyz)
-        np.ndarray: relevancy score
+        np.ndarray: points in LERF pointcloud (xyz), in world frame
+        torch.Tensor: relevancy score, on device
+        np.ndarray: points in DINO pointcloud (xyz), in world frame
+        torch.Tensor: pick object point, in world frame, on device
+        torch.Tensor: place point, in world frame, on device (None if not available)
     """
-    lerf_xyz, lerf_relevancy = [], []
-    center_pos_matrix = np.array([[ 1., 0., 0., 0.45], [0., -0.70710678,  0.70710678, -0.28284271],[ 0, -0.70710678, -0.70710678,  0.10284271]])
-    c2w = ns_wrapper.visercam_to_ns(center_pos_matrix)
-    rscam = RealsenseCamera.get_camera(c2w, downscale=1/4)
+    # The query camera only depends on the scene, so it is built once per scene
+    rscam = _relevancy_cameras.get(ns_wrapper)
+    if rscam is None:
+        c2w = ns_wrapper.visercam_to_ns(CENTER_POS_MATRIX)
+        rscam = _relevancy_cameras[ns_wrapper] = RealsenseCamera.get_camera(c2w, downscale=1/4)
     lerf_pcd, lerf_relevancy, dino_pcd, pick_object_pt, place_pt = ns_wrapper.get_lerf_pointcloud(rscam)
-    pick_object_pt = tr.transformations.transform_points(pick_object_pt.unsqueeze(0).cpu().numpy(), ns_wrapper.applied_transform).squeeze()
+    applied_transform = ns_wrapper.applied_transform.astype(np.float32)
+    # The relevancy and the pick/place points are kept on device, no host round-trip
+    T_ns2world = torch.as_tensor(applied_transform, device=device)
+    pick_object_pt = affine_transform(pick_object_pt.unsqueeze(0), T_ns2world).squeeze(0)
     if place_pt is not None:
-        place_pt = tr.transformations.transform_points(place_pt.unsqueeze(0).cpu().numpy(), ns_wrapper.applied_transform).squeeze()
-    lerf_pcd.points = o3d.utility.Vector3dVector(tr.transformations.transform_points(np.asarray(lerf_pcd.points), ns_wrapper.applied_transform)) #nerfstudio pc to world/viser pc
-    dino_pcd.points = o3d.utility.Vector3dVector(tr.transformations.transform_points(np.asarray(dino_pcd.points), ns_wrapper.applied_transform))
-    lerf_points_o3d = lerf_pcd.points
-    dino_points_o3d = dino_pcd.points
+        place_pt = affine_transform(place_pt.unsqueeze(0), T_ns2world).squeeze(0)
+    lerf_xyz = affine_transform(np.asarray(lerf_pcd.points, dtype=np.float32), applied_transform) #nerfstudio pc to world/viser pc
+    dino_xyz = affine_transform(np.asarray(dino_pcd.points, dtype=np.float32), applied_transform)
+    lerf_relevancy = lerf_relevancy.float()
+
+    return lerf_xyz, lerf_relevancy, dino_xyz, pick_object_pt, place_pt
+
+def fast_nms(
+    gg: GraspGroup,
+    translation_thresh: float = 0.03,
+    rotation_thresh: float = 30.0/180.0*np.pi,
+) -> GraspGroup:
+    """Grasp NMS, same criteria as `GraspGroup.nms` but without the all-pairs comparison.
+
+    Candidate pairs come from a KD-tree radius query on the translations, and the
+    rotation distance is only computed for those pairs.
+
+    Args:
+        gg (GraspGroup): grasps
+        translation_thresh (float): translation threshold (m)
+        rotation_thresh (float): rotation threshold (rad)
 
-    return lerf_points_o3d, lerf_relevancy, dino_points_o3d, pick_object_pt, place_pt
+    Returns:
+        GraspGroup: grasps after NMS, sorted by score
+    """
+    if len(gg) == 0:
+        return GraspGroup()
+    gg = GraspGroup(gg.grasp_group_array[np.argsort(-gg.scores, kind='stable')])
+
+    # pairs (i, j) with i < j, so i always has the higher score
+    pairs = cKDTree(gg.translations).query_pairs(translation_thresh, output_type='ndarray')
+    rotations = gg.rotation_matrices
+    trace = np.einsum('pij,pij->p', rotations[pairs[:, 0]], rotations[pairs[:, 1]])
+    pairs = pairs[np.arccos(np.clip((trace - 1) / 2, -1, 1)) < rotation_thresh]
+
+    # greedy suppression in score order, walking the neighbors of each kept grasp
+    pairs = pairs[np.argsort(pairs[:, 0], kind='stable')]
+    neighbor_starts = np.searchsorted(pairs[:, 0], np.arange(len(gg) + 1))
+    suppressed = np.zeros(len(gg), dtype=bool)
+    for i in np.unique(pairs[:, 0]):
+        if not suppressed[i]:
+            suppressed[pairs[neighbor_starts[i]:neighbor_starts[i+1], 1]] = True
+    return gg[~suppressed]
 
 def get_grasps(
     graspnet: GraspNetModule,
     world_pointcloud: tr.PointCloud,
     hemisphere: List[RigidTransform],
     graspnet_batch_size: int = 15,
+    collision_batch_size: int = 2000,
     ) -> GraspGroup:
     """Get grasps from graspnet, as images taken from the hemisphere
     
@@ -64,71 +137,80 @@ def get_grasps(
         graspnet (GraspNetModule): graspnet module
         world_pointcloud (tr.PointCloud): world pointcloud
         hemisphere (List[RigidTransform]): list of camera poses
+        graspnet_batch_size (int): number of views per GraspNet forward
+        collision_batch_size (int): number of grasps per collision check, bounds its (G, N, 3) buffers
     
     Returns:
         GraspGroup: grasps
     """
-    torch.cuda.empty_cache()
-    gg_all = None
-    for i in range(0, len(hemisphere), graspnet_batch_size):
-        start = time.time()
-        ind_range = range(i, min(i+graspnet_batch_size, len(hemisphere)))
-        rgbd_cropped_list = []
-        for j in ind_range:
-            c2w = hemisphere[j].matrix[:3,:]
-            rgbd_cropped = world_pointcloud.copy()
-            rgbd_cropped.vertices = tr.transformations.transform_points(
-                rgbd_cropped.vertices,
-                np.linalg.inv(np.concatenate([c2w, [[0, 0, 0, 1]]], axis=0))
-            )
-            rgbd_cropped_list.append(rgbd_cropped)
-        print("Transform time: ", time.time() - start)
-
-        gg_list = graspnet(rgbd_cropped_list)
-        for g_ind, gg in enumerate(gg_list):
-            c2w = hemisphere[i + g_ind].matrix[:3,:]
-            gg.transform(np.concatenate([c2w, [[0, 0, 0, 1]]], axis=0))
-        print(f"Grasp pred time: {time.time() - start:.2f}s")
-        start = time.time()
-
-        gg_all_curr = gg_list[0]
-        for gg in gg_list[1:]:
-            gg_all_curr.add(gg)
-        gg = gg_all_curr
-
-        # If the grasps are too close to the ground, then lift them a bit.
-        # This is hardcoded though, so it might not work for all scenes
-        gg_translations = gg.translations
-        gg_translations[gg_translations[:, 2] < -0.16] += np.tile(np.array([0, 0, 0.01]), ((gg_translations[:, 2] < -0.16).sum(), 1))
-        gg.translations = gg_translations
-        # gg[gg.translations[:, 2] < -0.16].translations += np.tile(np.array([0, 0, 0.04]), ((gg.translations[:, 2] < -0.16).sum(), 1))
-        gg = gg[(gg.translations[:, 0] > 0.22)] #& (gg.translations[:, 2] < 0.05)]
-
-        gg = gg[np.abs(gg.rotation_matrices[:, :, 1][:, 2]) < 0.5]
-
-        # gg = gg[gg.scores > 0.6]
-        if len(gg) == 0:
-            continue
-
-        gg = gg.nms(translation_thresh=0.01, rotation_thresh=30.0/180.0*np.pi)
-
-        # select grasps that are not too close to the table
-        # Currently, this function does general grasp filtering (using collision detection, grasp includes non-table components, ...)
-        gg = graspnet.local_collision_detection(gg)
-
-        print(f"Collision detection time: {time.time() - start:.2f}s")
-        print(f"Post proc time: {time.time() - start:.2f}s")
-        if gg_all is None:
-            gg_all = gg
-        else:
-            gg_all.add(gg)
-
-    if gg_all is None:
+    gg_all_list = []  # per-batch grasp arrays, concatenated once at the end
+    # Camera poses and their inverses, computed once for the whole hemisphere (V, 4, 4)
+    c2w_stack = np.empty((len(hemisphere), 4, 4))
+    c2w_stack[:, :3, :] = np.stack([h.matrix[:3, :] for h in hemisphere])
+    c2w_stack[:, 3] = [0, 0, 0, 1]
+    # The pointcloud math is done in float32, grasps are mapped back with the float64 poses
+    w2c_stack = np.linalg.inv(c2w_stack).astype(np.float32)
+    world_vertices = np.asarray(world_pointcloud.vertices, dtype=np.float32)
+    # Transform the world pointcloud into every camera frame of a batch at once (B, N, 3)
+    transform_batch = lambda i: affine_transform(world_vertices, w2c_stack[i:i+graspnet_batch_size])
+    # The next batch is transformed on a worker thread while GraspNet runs on the current one
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_batch = executor.submit(transform_batch, 0)
+        for i in range(0, len(hemisphere), graspnet_batch_size):
+            start = time.time()
+            rgbd_cropped_batch = next_batch.result()
+            if i + graspnet_batch_size < len(hemisphere):
+                next_batch = executor.submit(transform_batch, i + graspnet_batch_size)
+            print("Transform time: ", time.time() - start)
+
+            gg_list = graspnet(rgbd_cropped_batch)
+            for g_ind, gg in enumerate(gg_list):
+                gg.transform(c2w_stack[i + g_ind])
+            print(f"Grasp pred time: {time.time() - start:.2f}s")
+            start = time.time()
+
+            gg = GraspGroup(np.concatenate([gg.grasp_group_array for gg in gg_list], axis=0))
+
+            # If the grasps are too close to the ground, then lift them a bit.
+            # This is hardcoded though, so it might not work for all scenes
+            gg_translations = gg.translations  # view into gg.grasp_group_array, edited in place
+            gg_translations[gg_translations[:, 2] < -0.16, 2] += 0.01
+            # gg[gg.translations[:, 2] < -0.16].translations += np.tile(np.array([0, 0, 0.04]), ((gg.translations[:, 2] < -0.16).sum(), 1))
+            gg = gg[
+                (gg_translations[:, 0] > 0.22) #& (gg_translations[:, 2] < 0.05)
+                & (np.abs(gg.rotation_matrices[:, 2, 1]) < 0.5)
+            ]
+
+            # gg = gg[gg.scores > 0.6]
+            if len(gg) == 0:
+                continue
+
+            # Per-batch NMS only bounds the size of the global NMS input below
+            gg = fast_nms(gg, translation_thresh=0.01, rotation_thresh=30.0/180.0*np.pi)
+
+            print(f"Post proc time: {time.time() - start:.2f}s")
+            gg_all_list.append(gg.grasp_group_array)
+
+    if len(gg_all_list) == 0:
         return GraspGroup()
     
-    gg_all = gg_all.nms(translation_thresh=0.01, rotation_thresh=30.0/180.0*np.pi)
+    gg_all = GraspGroup(np.concatenate(gg_all_list, axis=0))
+
+    # select grasps that are not too close to the table
+    # Currently, this function does general grasp filtering (using collision detection, grasp includes non-table components, ...)
+    # This runs before the global NMS, so a colliding grasp can't suppress a clean neighbour from another batch,
+    # and on fixed-size slices, since the collision detector's memory grows with the number of grasps.
+    start = time.time()
+    gg_all = GraspGroup(np.concatenate([
+        graspnet.local_collision_detection(gg_all[i:i+collision_batch_size]).grasp_group_array
+        for i in range(0, len(gg_all), collision_batch_size)
+    ], axis=0))
+    print(f"Collision detection time: {time.time() - start:.2f}s")
+    if len(gg_all) == 0:
+        return gg_all
+
+    gg_all = fast_nms(gg_all, translation_thresh=0.01, rotation_thresh=30.0/180.0*np.pi)
     gg_all.sort_by_score()
-    torch.cuda.empty_cache()
 
     return gg_all
 
@@ -241,7 +323,8 @@ def instantiate_scene_from_model(
     hemi_phi_up = 70
 
     if osp.exists(f"outputs/{scene_name}/grasps.npy"):
-        grasps = GraspGroup(np.load(f"outputs/{scene_name}/grasps.npy"))
+        # Memory-mapped, rows are only read in when they are accessed
+        grasps = GraspGroup(np.load(f"outputs/{scene_name}/grasps.npy", mmap_mode='r'))
     else:
         grasp_hemisphere = _generate_hemi(
             hemi_radius,hemi_theta_N,hemi_phi_N,
@@ -254,7 +337,7 @@ def instantiate_scene_from_model(
 
     # # just add all the grasps lol
     # for i, grasp in enumerate(grasps):
-    #     add_grasps(server, grasp, i, 0.5)
+    #     add_grasps(server, grasp, i, GRASP_COLORMAP(0.5)[:3])
 
     return (
         ns_wrapper,
@@ -269,7 +352,7 @@ def add_grasps(
     server: viser.ViserServer,
     grasp: Grasp,
     ind: int,
-    score: float,
+    color: np.ndarray,
 ) -> Tuple[viser.SceneNodeHandle, viser.SceneNodeHandle, viser.SceneNodeHandle, viser.SceneNodeHandle]:
     """Curry function for adding grasps to the scene.
 
@@ -277,7 +360,7 @@ def add_grasps(
         server (viser.ViserServer): _description_
         grasp (Grasp): _description_
         ind (int): _description_
-        score (float): The color is based on the score -- put it from 0 to 1
+        color (np.ndarray): RGB color of the grasp mesh, usually `GRASP_COLORMAP(score)[:3]` with score from 0 to 1
 
     Returns:
         Tuple[viser.SceneNodeHandle, viser.SceneNodeHandle, viser.SceneNodeHandle]:
@@ -285,16 +368,7 @@ def add_grasps(
          - grasp_handle: mesh
          - ur5_handle: [UR5 frame (EE)] to [Grasp frame (graspnetAPI)]
     """
-    colormap = matplotlib.colormaps['RdYlGn']
-    robot_frame_R = RigidTransform(
-        rotation=RigidTransform.y_axis_rotation(np.pi/2) @ RigidTransform.z_axis_rotation(np.pi/2)
-    )
-
-    default_grasp = Grasp()
-    default_grasp.depth = grasp.depth
-    default_grasp.width = grasp.width
-    default_grasp.height = grasp.height
-    default_grasp = default_grasp.to_open3d_geometry()
+    gripper_vertices, gripper_faces = get_gripper_mesh(round(grasp.depth, 4), round(grasp.width, 4))
 
     frame_handle = server.add_frame(
         name=f'/lerf/grasps_{ind}',
@@ -304,13 +378,13 @@ def add_grasps(
     )
     grasp_handle = server.add_mesh(
         name=f'/lerf/grasps_{ind}/mesh',
-        vertices=np.asarray(default_grasp.vertices),
-        faces=np.asarray(default_grasp.triangles),
-        color=colormap(score)[:3],
+        vertices=gripper_vertices,
+        faces=gripper_faces,
+        color=color,
     )
     ur5_handle = server.add_frame(
         name=f'/lerf/grasps_{ind}/ur5',
-        wxyz=robot_frame_R.quaternion,
+        wxyz=UR5_FRAME_WXYZ,
         # position=np.array([0.03, 0, 0]),
         position=np.array([grasp.depth-0.015, 0, 0]),
         axes_length=0.05,
@@ -321,15 +395,64 @@ def add_grasps(
     return frame_handle, grasp_handle, ur5_handle
 
 
-def get_bbox_from_grasp(gg: Grasp) -> o3d.geometry.OrientedBoundingBox:
-    center = gg.translation
-    R = gg.rotation_matrix
-    H= np.eye(4)
-    H[:3,:3] = R
-    H[:3,3] = center
-    extent=np.array((gg.depth,gg.width,gg.height))
-    box = o3d.geometry.OrientedBoundingBox(center,H[:3,:3],extent)
-    return box
+@torch.no_grad()
+def get_grasp_scores(
+    grasps: GraspGroup,
+    lerf_points: np.ndarray,
+    lerf_relevancy: torch.Tensor,
+    dino_points: np.ndarray,
+    chunk_size: int = 256,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Score all grasps against the LERF/DINO pointclouds on `device`, `chunk_size` grasps at a time.
+
+    Args:
+        grasps (GraspGroup): grasps to score
+        lerf_points (np.ndarray): LERF pointcloud, (N, 3)
+        lerf_relevancy (torch.Tensor): LERF relevancy per point, (N,) or (N, 1), on device or as np.ndarray
+        dino_points (np.ndarray): DINO pointcloud, (M, 3)
+        chunk_size (int): number of grasps tested at once, bounds the (chunk, N, 3) buffer
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]:
+         - lerf_scores: median LERF relevancy inside each grasp box, 0 if the box is empty
+         - geom_scores: graspnet score, 0 if the box contains no DINO points
+    """
+    if len(grasps) == 0:
+        return np.zeros(0), np.zeros(0)
+    lerf_scores = np.zeros(len(grasps))
+    has_dino = np.zeros(len(grasps), dtype=bool)
+
+    # A box can only contain points within its circumradius of its center, so grasps
+    # with no LERF/DINO point that close score 0 without running the box test.
+    centers, _, half_extents = get_bboxes_from_grasps(grasps.grasp_group_array)
+    radii = np.linalg.norm(half_extents, axis=1) + 1e-6
+    def is_near(points):
+        if len(points) == 0:
+            return np.zeros(len(grasps), dtype=bool)
+        dists, _ = cKDTree(points).query(centers, k=1, distance_upper_bound=radii.max())
+        return dists <= radii
+    candidates = np.flatnonzero(is_near(lerf_points) | is_near(dino_points))
+    if len(candidates) == 0:
+        return lerf_scores, has_dino * grasps.grasp_group_array[:, 0]
+
+    to_tensor = lambda x: torch.as_tensor(x, dtype=torch.float32, device=device)
+    lerf_points, dino_points = to_tensor(lerf_points), to_tensor(dino_points)
+    lerf_relevancy = to_tensor(lerf_relevancy).reshape(-1)
+    # one float32 upload of the candidate grasps, the boxes are slices of it
+    grasp_array = to_tensor(grasps.grasp_group_array[candidates])
+    centers, rotations, half_extents = get_bboxes_from_grasps(grasp_array)
+
+    # results stay on device until the single copy back at the end
+    candidate_lerf_scores = torch.zeros(len(candidates), dtype=torch.float32, device=device)
+    candidate_has_dino = torch.zeros(len(candidates), dtype=torch.bool, device=device)
+    for i in range(0, len(candidates), chunk_size):
+        box = (centers[i:i+chunk_size], rotations[i:i+chunk_size], half_extents[i:i+chunk_size])
+        candidate_lerf_scores[i:i+chunk_size], _ = get_masked_median(lerf_relevancy, get_points_in_bboxes(lerf_points, *box))
+        candidate_has_dino[i:i+chunk_size] = get_points_in_bboxes(dino_points, *box).any(dim=1)
+    lerf_scores[candidates] = candidate_lerf_scores.cpu().numpy()
+    has_dino[candidates] = candidate_has_dino.cpu().numpy()
+    geom_scores = np.where(has_dino, grasps.grasp_group_array[:, 0], 0.0)
+    return lerf_scores, geom_scores
 
 
 def main(
@@ -352,7 +475,7 @@ def main(
 
     # Create all necessary global variables
     grasps, grasps_dict, lerf_scores, geom_scores, overall_scores, pick_object_pt, place_point, grasp_point, fin_grasp = None, {}, [], [], [], None, None, None, None
-    lerf_points_o3d, lerf_relevancy = None, None
+    lerf_xyz, lerf_relevancy = None, None
     print("config path")
     if config_path is not None:
         # ns_wrapper, world_pointcloud, global_pointcloud, table_center, grasps, overall_scores = instantiate_scene_from_model(
@@ -405,6 +528,8 @@ def main(
             # this doesn't actually seem to work, need to figure out why...
             del ns_wrapper.pipeline
             world_pointcloud, global_pointcloud, table_center, grasps, overall_scores = None, None, None, None, None
+            # Releasing the cached blocks is intended here (the whole scene is dropped),
+            # unlike in the per-scene hot paths where the caching allocator reuses them.
             torch.cuda.empty_cache()
 
 
@@ -527,7 +652,7 @@ def main(
         """
         @gen_grasp_button.on_click
         def _(_):
-            nonlocal lerf_points_o3d, lerf_relevancy, grasps_dict, lerf_scores,ns_wrapper, pick_object_pt, place_point
+            nonlocal lerf_xyz, lerf_relevancy, grasps_dict, lerf_scores,ns_wrapper, pick_object_pt, place_point
             nonlocal geom_scores
             gen_grasp_text.disabled = True
             gen_grasp_button.disabled = True
@@ -549,41 +674,26 @@ def main(
 
             # Get the LERF activation pointcloud for the given query
             ns_wrapper.pipeline.image_encoder.set_positives(lerf_word)
-            lerf_points_o3d, lerf_relevancy, dino_pcd, pick_object_pt, place_point = get_relevancy_pointcloud(ns_wrapper, table_center=table_center)
+            lerf_xyz, lerf_relevancy, dino_xyz, pick_object_pt, place_point = get_relevancy_pointcloud(ns_wrapper, table_center=table_center)
             # Visualize the relevancy pointcloud 
-            colors = lerf_relevancy.squeeze()
+            colors = lerf_relevancy.squeeze().cpu().numpy()
             colors = (colors - colors.min()) / (colors.max() - colors.min() + 1e-6)
-            colors = matplotlib.colormaps['viridis'](colors)[:, :3]
+            colors = RELEVANCY_COLOR_LUT[np.clip((colors * 256).astype(np.int32), 0, 255)]
             if lerf_weight > 0:
                 server.add_point_cloud(
                     name=f"/lerf_pointcloud",
-                    points=np.asarray(lerf_points_o3d),
+                    points=lerf_xyz,
                     colors=colors,
                     point_size=0.007,
                 )
 
-            lerf_scores = []
-            geom_scores = []
-            for i, grasp in enumerate(grasps):
-                box = get_bbox_from_grasp(grasp)
-                # get the indices of the lerf_xyz pointcloud which lie inside the box and avg
-                pts = box.get_point_indices_within_bounding_box(lerf_points_o3d)
-                pts1 = box.get_point_indices_within_bounding_box(dino_pcd)
-                if len(pts) == 0:
-                    score = 0.0
-                else:
-                    # score = lerf_relevancy[pts].mean()
-                    score = np.median(lerf_relevancy[pts].squeeze()).item()
-                score1 = grasp.score
-                if len(pts1) == 0:
-                    score1 = 0.0
-                
-                lerf_scores.append(score)
-                geom_scores.append(score1)
+            # median relevancy of the lerf_xyz points inside each grasp box
+            lerf_scores, geom_scores = get_grasp_scores(
+                grasps, lerf_xyz, lerf_relevancy, dino_xyz
+            )
 
             #All visualization stuff
-            lerf_scores = np.array(lerf_scores)
-            lerf_scores /= lerf_relevancy.max()
+            lerf_scores /= lerf_relevancy.max().item()
 
             gen_grasp_text.disabled = False
             gen_grasp_button.disabled = False
@@ -609,23 +719,29 @@ def main(
                 return
 
             scores_threshold = np.quantile(scores, update_overall_scores_threshold.value)
-            grasps_selected = [grasp for (ind, grasp) in enumerate(grasps) if scores[ind] > scores_threshold]
-            inds_selected = [ind for (ind, grasp) in enumerate(grasps) if scores[ind] > scores_threshold]
-
-            grasps_selected = GraspGroup(np.stack([grasp.grasp_array for grasp in grasps_selected]))
+            inds_selected = np.flatnonzero(scores > scores_threshold)
+            # best overall score first, so grasps_selected[i] is grasp inds_selected[i]
+            inds_selected = inds_selected[np.argsort(-scores[inds_selected], kind='stable')]
+            if len(inds_selected) == 0:
+                print("No grasps above the quantile threshold!")
+                return
+            # Fancy indexing copies only the selected rows out of the (memory-mapped) grasp array
+            grasps_selected = GraspGroup(grasps.grasp_group_array[inds_selected])
             # grasps_selected = grasps_selected.nms(translation_thresh=0.02, rotation_thresh=30.0/180.0*np.pi)
-            grasps_selected = grasps_selected.sort_by_score()
 
-            for ind, grasp_list in grasps_dict.items():
-                for grasp in grasp_list:
-                    grasp.remove()
+            # The mesh and UR5 frame are children of the grasp frame, and go away with it
+            for frame_handle, _, _ in grasps_dict.values():
+                frame_handle.remove()
             grasps_dict = {}
 
-            scores -= scores[inds_selected].min()
-            scores /= scores[inds_selected].max()
+            # inds_selected is sorted by score, so its first/last entries are the selection's max/min.
+            # This also makes a new array, rather than normalizing lerf_scores/geom_scores in place.
+            max_score, min_score = scores[inds_selected[0]], scores[inds_selected[-1]]
+            scores = (scores - min_score) / (max_score - min_score)
 
-            for ind, grasp in zip(inds_selected, grasps_selected):
-                grasps_dict[ind] = add_grasps(server, grasp, ind, scores[ind])
+            colors = GRASP_COLORMAP(scores[inds_selected])[:, :3]
+            for ind, grasp, color in zip(inds_selected, grasps_selected, colors):
+                grasps_dict[ind] = add_grasps(server, grasp, ind, color)
 
             overall_scores = scores
 
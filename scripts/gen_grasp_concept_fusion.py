@@ -26,12 +26,22 @@ from graspnetAPI import GraspGroup, Grasp
 from nerfstudio.pipelines.base_pipeline import Pipeline
 
 from robot_lerf.graspnet_baseline.load_ns_model import NerfstudioWrapper, RealsenseCamera
-from robot_lerf.graspnet_baseline.graspnet_module import GraspNetModule
+from robot_lerf.graspnet_baseline.graspnet_module import (
+    GraspNetModule, get_gripper_mesh, get_bboxes_from_grasps, get_points_in_bboxes, get_masked_median
+)
 from robot_lerf.capture_utils import _generate_hemi
 from robot_lerf.grasp_planner_cmk import UR5GraspPlanner # , UR5_HOME_JOINT, ARM_JOINT_NAMES
 
 import capture as lerf_capture
 
+GRASP_COLORMAP = matplotlib.colormaps['RdYlGn']
+# [UR5 frame (EE)] to [Grasp frame (graspnetAPI)] rotation, as wxyz
+UR5_FRAME_WXYZ = RigidTransform(
+    rotation=RigidTransform.y_axis_rotation(np.pi/2) @ RigidTransform.z_axis_rotation(np.pi/2)
+).quaternion
+# viridis sampled at its 256 entries; indexing with floor(256 * x) matches calling the colormap on x in [0, 1]
+RELEVANCY_COLOR_LUT = matplotlib.colormaps['viridis'](np.arange(256))[:, :3].astype(np.float32)
+
 
 def get_relevancy_pointcloud(ns_wrapper: NerfstudioWrapper, **kwargs):
     """Get relevancy pointcloud, used to get semantic score
@@ -40,19 +50,17 @@ def get_relevancy_pointcloud(ns_wrapper: NerfstudioWrapper, **kwargs):
         ns_wrapper (NerfstudioWrapper): nerf scene
 
     Returns:
-        o3d.utility.Vector3DVector: points in pointcloud (xyz)
-        np.ndarray: relevancy score
+        np.ndarray: points in pointcloud (xyz), (N, 3)
+        np.ndarray: relevancy score, (N,)
     """
-    lerf_xyz, lerf_relevancy = [], []
     center_pos_matrix = np.array([[ 1., 0., 0., 0.45], [0., -0.70710678,  0.70710678, -0.28284271],[ 0, -0.70710678, -0.70710678,  0.10284271]])
     c2w = ns_wrapper.visercam_to_ns(center_pos_matrix)
     rscam = RealsenseCamera.get_camera(c2w, downscale=1/5)
-    lerf_pcd, lerf_relevancy = ns_wrapper.get_lerf_pointcloud(rscam)
-    lerf_pcd.points = o3d.utility.Vector3dVector(tr.transformations.transform_points(np.asarray(lerf_pcd.points), ns_wrapper.applied_transform)) #nerfstudio pc to world/viser pc
-    lerf_xyz = np.asarray(lerf_pcd.points)
-    lerf_points_o3d = lerf_pcd.points
+    lerf_pcd, lerf_relevancy, *_ = ns_wrapper.get_lerf_pointcloud(rscam)
+    lerf_xyz = tr.transformations.transform_points(np.asarray(lerf_pcd.points), ns_wrapper.applied_transform).astype(np.float32) #nerfstudio pc to world/viser pc
+    lerf_relevancy = lerf_relevancy.squeeze().float().cpu().numpy().reshape(-1)
 
-    return lerf_points_o3d, lerf_relevancy
+    return lerf_xyz, lerf_relevancy
 
 def get_grasps(
     graspnet: GraspNetModule,
@@ -100,9 +108,8 @@ def get_grasps(
 
         # If the grasps are too close to the ground, then lift them a bit.
         # This is hardcoded though, so it might not work for all scenes
-        gg_translations = gg.translations
-        gg_translations[gg_translations[:, 2] < -0.16] += np.tile(np.array([0, 0, 0.01]), ((gg_translations[:, 2] < -0.16).sum(), 1))
-        gg.translations = gg_translations
+        gg_translations = gg.translations  # view into gg.grasp_group_array, edited in place
+        gg_translations[gg_translations[:, 2] < -0.16, 2] += 0.01
         # gg[gg.translations[:, 2] < -0.16].translations += np.tile(np.array([0, 0, 0.04]), ((gg.translations[:, 2] < -0.16).sum(), 1))
         gg = gg[(gg.translations[:, 0] > 0.22) & (gg.translations[:, 2] < 0.05)]
 
@@ -317,16 +324,7 @@ def add_grasps(
          - grasp_handle: mesh
          - ur5_handle: [UR5 frame (EE)] to [Grasp frame (graspnetAPI)]
     """
-    colormap = matplotlib.colormaps['RdYlGn']
-    robot_frame_R = RigidTransform(
-        rotation=RigidTransform.y_axis_rotation(np.pi/2) @ RigidTransform.z_axis_rotation(np.pi/2)
-    )
-
-    default_grasp = Grasp()
-    default_grasp.depth = grasp.depth
-    default_grasp.width = grasp.width
-    default_grasp.height = grasp.height
-    default_grasp = default_grasp.to_open3d_geometry()
+    gripper_vertices, gripper_faces = get_gripper_mesh(round(grasp.depth, 4), round(grasp.width, 4))
 
     frame_handle = server.add_frame(
         name=f'/lerf/grasps_{ind}',
@@ -336,13 +334,13 @@ def add_grasps(
     )
     grasp_handle = server.add_mesh(
         name=f'/lerf/grasps_{ind}/mesh',
-        vertices=np.asarray(default_grasp.vertices),
-        faces=np.asarray(default_grasp.triangles),
-        color=colormap(score)[:3],
+        vertices=gripper_vertices,
+        faces=gripper_faces,
+        color=GRASP_COLORMAP(score)[:3],
     )
     ur5_handle = server.add_frame(
         name=f'/lerf/grasps_{ind}/ur5',
-        wxyz=robot_frame_R.quaternion,
+        wxyz=UR5_FRAME_WXYZ,
         # position=np.array([0.03, 0, 0]),
         position=np.array([grasp.depth, 0, 0]),
         axes_length=0.05,
@@ -353,15 +351,85 @@ def add_grasps(
     return frame_handle, grasp_handle, ur5_handle
 
 
-def get_bbox_from_grasp(gg: Grasp) -> o3d.geometry.OrientedBoundingBox:
-    center = gg.translation
-    R = gg.rotation_matrix
-    H= np.eye(4)
-    H[:3,:3] = R
-    H[:3,3] = center
-    extent=np.array((gg.depth,gg.width,gg.height))
-    box = o3d.geometry.OrientedBoundingBox(center,H[:3,:3],extent)
-    return box
+@torch.no_grad()
+def get_grasp_lerf_scores(
+    grasps: GraspGroup,
+    points: np.ndarray,
+    relevancy: np.ndarray,
+    chunk_size: int = 64,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Median relevancy of the points inside each grasp box, vectorized over `chunk_size` grasps at a time.
+
+    Args:
+        grasps (GraspGroup): grasps to score
+        points (np.ndarray): relevancy pointcloud, (N, 3)
+        relevancy (np.ndarray): relevancy per point, (N,) or (N, 1)
+        chunk_size (int): number of grasps tested at once, bounds the (chunk, N, 3) buffer
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]:
+         - scores: score per grasp, 0 if its box contains no points
+         - counts: number of points inside each grasp box
+    """
+    scores = np.zeros(len(grasps))
+    counts = np.zeros(len(grasps), dtype=int)
+    if len(grasps) == 0:
+        return scores, counts
+    to_tensor = lambda x: torch.as_tensor(x, dtype=torch.float32, device=device)
+    points = to_tensor(points)
+    relevancy = to_tensor(relevancy).reshape(-1)
+    centers, rotations, half_extents = get_bboxes_from_grasps(to_tensor(grasps.grasp_group_array))
+    for i in range(0, len(grasps), chunk_size):
+        box = (centers[i:i+chunk_size], rotations[i:i+chunk_size], half_extents[i:i+chunk_size])
+        median, count = get_masked_median(relevancy, get_points_in_bboxes(points, *box))
+        scores[i:i+chunk_size] = median.cpu().numpy()
+        counts[i:i+chunk_size] = count.cpu().numpy()
+    return scores, counts
+
+
+def to_homogeneous(translation: np.ndarray = None, rotation: np.ndarray = None) -> np.ndarray:
+    """4x4 homogeneous transform, for composing poses as plain matrix products.
+
+    Args:
+        translation (np.ndarray): translation, (3,); zero if None
+        rotation (np.ndarray): rotation matrix, (3, 3); identity if None
+
+    Returns:
+        np.ndarray: homogeneous transform, (4, 4)
+    """
+    H = np.eye(4)
+    if rotation is not None:
+        H[:3, :3] = rotation
+    if translation is not None:
+        H[:3, 3] = translation
+    return H
+
+
+# Rotations about the grasp y-axis tried when planning a trajectory to a grasp, as (N, 4, 4)
+NUM_ROTATIONS_TEST = 8
+GRASP_TEST_ROTATIONS = np.stack([
+    to_homogeneous(rotation=RigidTransform.y_axis_rotation(i * (2*np.pi)/NUM_ROTATIONS_TEST))
+    for i in range(NUM_ROTATIONS_TEST)
+])
+
+# Number of waypoints of the approach part of the grasp trajectory, the rest is the lift
+TRAJ_GOTO_LEN = 61
+
+def move_joint_path(robot, traj: np.ndarray, vel: float = 0.2, acc: float = 1.0, blend: float = 0.01):
+    """Blocking move along a joint trajectory, at constant speed and blending, stopping at the last waypoint.
+
+    Args:
+        robot (UR5Robot): robot to move
+        traj (np.ndarray): joint trajectory, (T, 6)
+    """
+    n = len(traj)
+    robot.move_joint_path(
+        traj,
+        vels=[vel]*n,
+        accs=[acc]*n,
+        blends=[blend]*(n-1)+[0],
+        asyn=False
+        )
 
 
 def main(
@@ -391,7 +459,8 @@ def main(
 
     # Create all necessary global variables
     grasps, grasps_dict, lerf_scores, overall_scores = None, {}, [], []
-    lerf_points_o3d, lerf_relevancy = None, None
+    lerf_counts = None  # number of relevancy points inside each grasp box, from the last query
+    lerf_xyz, lerf_relevancy = None, None  # as (N, 3) / (N,) float32 arrays, converted once per query
     traj = None
     if config_path is not None:
         ns_wrapper, world_pointcloud, global_pointcloud, table_center, grasps, overall_scores = instantiate_scene_from_model(
@@ -469,7 +538,7 @@ def main(
 
         @cf_train_button.on_click
         def _(_):
-            nonlocal ns_wrapper, world_pointcloud, global_pointcloud, table_center, grasps, overall_scores
+            nonlocal ns_wrapper, world_pointcloud, global_pointcloud, table_center, grasps, overall_scores, lerf_scores, lerf_counts
             if cf_dataset_path.value == "":
                 print("Please enter a dataset path!")
                 return
@@ -527,6 +596,8 @@ def main(
                 pipeline=pipeline,
                 scene_name=cf_dataset_path.value
             )
+            # the LERF scores/counts index the old grasps
+            lerf_scores, lerf_counts = None, None
     
 
     """
@@ -555,18 +626,20 @@ def main(
 
         @lerf_reset_button.on_click
         def _(_):
-            nonlocal ns_wrapper, world_pointcloud, global_pointcloud, table_center, grasps, overall_scores
+            nonlocal ns_wrapper, world_pointcloud, global_pointcloud, table_center, grasps, overall_scores, lerf_scores, lerf_counts
             if ns_wrapper is None:
                 return
             # this doesn't actually seem to work, need to figure out why...
             del ns_wrapper.pipeline
             world_pointcloud, global_pointcloud, table_center, grasps, overall_scores = None, None, None, None, None
+            # the LERF scores/counts index the old grasps
+            lerf_scores, lerf_counts = None, None
             torch.cuda.empty_cache()
 
 
         @lerf_train_button.on_click
         def _(_):
-            nonlocal ns_wrapper, world_pointcloud, global_pointcloud, table_center, grasps, overall_scores
+            nonlocal ns_wrapper, world_pointcloud, global_pointcloud, table_center, grasps, overall_scores, lerf_scores, lerf_counts
             data = Path(f'output/{lerf_dataset_path.value}/')
             if not osp.exists(data):
                 print("data file doesn't exist; can't load/train; return")
@@ -622,6 +695,8 @@ def main(
                 pipeline=pipeline,
                 scene_name=lerf_dataset_path.value
             )
+            # the LERF scores/counts index the old grasps
+            lerf_scores, lerf_counts = None, None
             lerf_train_button.disabled = False
 
     """
@@ -733,14 +808,8 @@ def main(
                 robot.move_joint(grasp_planner.UR5_HOME_JOINT, vel=0.5, asyn=False)
                 time.sleep(0.5)
                 robot.gripper.open()
-                traj_goto, traj_lift = traj[:61], traj[61:]
-                robot.move_joint_path(
-                    traj_goto,
-                    vels=[.2]*len(traj_goto),
-                    accs=[1]*len(traj_goto),
-                    blends = [0.01]*(len(traj_goto)-1)+[0],
-                    asyn=False
-                    )
+                traj_goto, traj_lift = traj[:TRAJ_GOTO_LEN], traj[TRAJ_GOTO_LEN:]
+                move_joint_path(robot, traj_goto)
                 robot.move_joint(traj_goto[-1], asyn=False,vel=.1)
                 
                 joints = robot.get_joints()
@@ -762,13 +831,7 @@ def main(
                     robot.gripper.close()
                     time.sleep(2)
                     if 'y' in input("Lift gripper"):
-                        robot.move_joint_path(
-                            traj_lift,
-                            vels=[.2]*len(traj_lift),
-                            accs=[1]*len(traj_lift),
-                            blends = [0.01]*(len(traj_lift)-1)+[0],
-                            asyn=False
-                            )
+                        move_joint_path(robot, traj_lift)
                         time.sleep(0.5)
                         if 'y' in input("Open gripper"):
                             robot.gripper.open()
@@ -830,16 +893,37 @@ def main(
                 step=0.01,
             )
 
+        def update_lerf_scores():
+            """Show the current relevancy pointcloud, and score the grasps against it.
+            Shared by the LERF and concept fusion queries, which only differ in how the relevancy is computed."""
+            nonlocal lerf_scores, lerf_counts
+            colors = lerf_relevancy
+            colors = (colors - colors.min()) / (colors.max() - colors.min() + 1e-6)
+            colors = RELEVANCY_COLOR_LUT[np.clip((colors * 256).astype(np.int32), 0, 255)]
+            server.add_point_cloud(
+                name=f"/lerf_pointcloud",
+                points=lerf_xyz,
+                colors=colors,
+                point_size=0.003,
+            )
+
+            # median relevancy of the lerf_xyz points inside each grasp box
+            lerf_scores, lerf_counts = get_grasp_lerf_scores(grasps, lerf_xyz, lerf_relevancy)
+
+            #All visualization stuff
+            lerf_scores /= lerf_relevancy.max()
+
         """
         Updates concpet fusion scores by updating the concept fusion query
         """
         @gen_grasp_button_cf.on_click
         def _(_):
-            nonlocal lerf_points_o3d, lerf_relevancy, grasps_dict, lerf_scores
+            nonlocal lerf_xyz, lerf_relevancy, grasps_dict, lerf_scores
             gen_grasp_button_cf.disabled = True
             gen_grasp_text.disabled = True
             lerf_points_o3d, lerf_relevancy = compute_conceptfusion_relevancy(gen_grasp_text_cf.value, f"cf/{cf_dataset_path.value}/saved-map", ns_wrapper)
-            lerf_relevancy = lerf_relevancy.T.cpu().detach().numpy()
+            lerf_xyz = np.asarray(lerf_points_o3d, dtype=np.float32)
+            lerf_relevancy = lerf_relevancy.T.float().cpu().detach().numpy().reshape(-1)
             # import pdb; pdb.set_trace()
             # lerf_points_o3d, lerf_relevancy = get_relevancy_pointcloud(ns_wrapper, table_center=table_center)
             # Visualize the relevancy pointcloud 
@@ -848,36 +932,7 @@ def main(
             # lerf_xyz = np.asarray(lerf_pcd.points)
             # lerf_points_o3d = lerf_pcd.points
 
-            colors = lerf_relevancy.squeeze()
-            colors = (colors - colors.min()) / (colors.max() - colors.min() + 1e-6)
-            colors = matplotlib.colormaps['viridis'](colors)[:, :3]
-            server.add_point_cloud(
-                name=f"/lerf_pointcloud",
-                points=np.asarray(lerf_points_o3d),
-                colors=colors,
-                point_size=0.003,
-            )
-
-            lerf_scores = []
-            for i, grasp in enumerate(grasps):
-                box = get_bbox_from_grasp(grasp)
-                # get the indices of the lerf_xyz pointcloud which lie inside the box and avg
-                pts = box.get_point_indices_within_bounding_box(lerf_points_o3d)
-                if len(pts) == 0:
-                    score = 0
-                else:
-                    # score = lerf_relevancy[pts].mean()
-                    score = np.median(lerf_relevancy[pts].squeeze()).item()
-                    # server.add_point_cloud(
-                    #     name=f"/lerf_pointcloud_{i}",
-                    #     points=np.asarray(lerf_points_o3d)[pts],
-                    #     colors=matplotlib.cmaps['viridis'](lerf_relevancy[pts].squeeze())[:, :3],
-                    # )
-                lerf_scores.append(score)
-
-            #All visualization stuff
-            lerf_scores = np.array(lerf_scores)
-            lerf_scores /= lerf_relevancy.max()
+            update_lerf_scores()
 
             gen_grasp_text.disabled = False
             gen_grasp_button_cf.disabled = False
@@ -887,7 +942,7 @@ def main(
         """
         @gen_grasp_button.on_click
         def _(_):
-            nonlocal lerf_points_o3d, lerf_relevancy, grasps_dict, lerf_scores
+            nonlocal lerf_xyz, lerf_relevancy, grasps_dict, lerf_scores
             gen_grasp_text.disabled = True
             gen_grasp_button.disabled = True
 
@@ -900,34 +955,9 @@ def main(
 
             # Get the LERF activation pointcloud for the given query
             ns_wrapper.pipeline.image_encoder.set_positives(lerf_word)
-            lerf_points_o3d, lerf_relevancy = get_relevancy_pointcloud(ns_wrapper, table_center=table_center)
+            lerf_xyz, lerf_relevancy = get_relevancy_pointcloud(ns_wrapper, table_center=table_center)
             # Visualize the relevancy pointcloud 
-            colors = lerf_relevancy.squeeze()
-            colors = (colors - colors.min()) / (colors.max() - colors.min() + 1e-6)
-            colors = matplotlib.colormaps['viridis'](colors)[:, :3]
-            server.add_point_cloud(
-                name=f"/lerf_pointcloud",
-                points=np.asarray(lerf_points_o3d),
-                colors=colors,
-                point_size=0.003,
-            )
-
-            lerf_scores = []
-            for i, grasp in enumerate(grasps):
-                box = get_bbox_from_grasp(grasp)
-                # get the indices of the lerf_xyz pointcloud which lie inside the box and avg
-                pts = box.get_point_indices_within_bounding_box(lerf_points_o3d)
-                if len(pts) == 0:
-                    score = 0
-                else:
-                    # score = lerf_relevancy[pts].mean()
-                    score = np.median(lerf_relevancy[pts].squeeze()).item()
-
-                lerf_scores.append(score)
-
-            #All visualization stuff
-            lerf_scores = np.array(lerf_scores)
-            lerf_scores /= lerf_relevancy.max()
+            update_lerf_scores()
 
             gen_grasp_text.disabled = False
             gen_grasp_button.disabled = False
@@ -942,32 +972,33 @@ def main(
             lerf_weight = update_overall_scores_slider.value
             geom_weight = 1.0 - lerf_weight
             # Update the scores...
+            # grasps are stored as one (G, 17) array, index it instead of iterating Grasp objects
+            grasp_array = grasps.grasp_group_array
             if lerf_scores is None or len(lerf_scores) == 0:
-                scores = grasps.scores
+                scores = grasp_array[:, 0]
             else:
-                scores = (lerf_weight)*np.array(lerf_scores) + (geom_weight)*np.array(grasps.scores)
+                scores = (lerf_weight)*np.array(lerf_scores) + (geom_weight)*grasp_array[:, 0]
 
             scores_threshold = np.quantile(scores, update_overall_scores_threshold.value)
 
-            grasps_selected = [grasp for (ind, grasp) in enumerate(grasps) if scores[ind] > scores_threshold]
-            inds_selected = [ind for (ind, grasp) in enumerate(grasps) if scores[ind] > scores_threshold]
-
-            grasps_selected = GraspGroup(np.stack([grasp.grasp_array for grasp in grasps_selected]))
+            inds_selected = np.flatnonzero(scores > scores_threshold)
+            # best overall score first, so grasps_selected[i] is grasp inds_selected[i]
+            inds_selected = inds_selected[np.argsort(-scores[inds_selected], kind='stable')]
+            if len(inds_selected) == 0:
+                print("No grasps above the quantile threshold!")
+                return
+            grasps_selected = GraspGroup(grasp_array[inds_selected])
             # grasps_selected = grasps_selected.nms(translation_thresh=0.02, rotation_thresh=30.0/180.0*np.pi)
-            grasps_selected = grasps_selected.sort_by_score()
 
-            for ind, grasp_list in grasps_dict.items():
-                for grasp in grasp_list:
-                    grasp.remove()
+            # The mesh and UR5 frame are children of the grasp frame, and go away with it
+            for frame_handle, _, _ in grasps_dict.values():
+                frame_handle.remove()
             grasps_dict = {}
 
-            # min_score, max_score = scores[inds_selected].min(), scores[inds_selected].max()
-            # print(scores[inds_selected].min(), scores[inds_selected].max())
-            # scores -= min_score
-            # scores /= max_score
-            # print(scores[inds_selected].min(), scores[inds_selected].max())
-            scores -= scores[inds_selected].min()
-            scores /= scores[inds_selected].max()
+            # inds_selected is sorted by score, so its first/last entries are the selection's max/min.
+            # This also makes a new array, rather than normalizing the grasp scores in place.
+            max_score, min_score = scores[inds_selected[0]], scores[inds_selected[-1]]
+            scores = (scores - min_score) / (max_score - min_score)
 
             for ind, grasp in zip(inds_selected, grasps_selected):
                 grasps_dict[ind] = add_grasps(server, grasp, ind, scores[ind])
@@ -1003,37 +1034,38 @@ def main(
 
             # traj_grasp_ind_list = np.argsort(grasps.scores)[::-1]
             traj_grasp_ind_list = np.argsort(scores)[::-1]
+            succ_traj_list = []
             for traj_grasp_ind in traj_grasp_ind_list:
+                # Planning is the expensive part: skip grasps that aren't shown,
+                # or, when the LERF score is weighted in, whose box holds none of the queried object's points
+                if traj_grasp_ind not in grasps_dict or (
+                    update_overall_scores_slider.value > 0 and lerf_counts is not None and lerf_counts[traj_grasp_ind] == 0
+                ):
+                    continue
                 ur52grasp_pose = grasps_dict[traj_grasp_ind][-1]
                 grasp2world_pose = grasps_dict[traj_grasp_ind][0]
 
-                num_rotations_test = 8
-
                 succ_traj_list = [] # store (traj, fin_pose)
                 ur5_frame.visible = False
 
+                # grasp -> world and ee -> grasp, composed with all test rotations at once, (N, 4, 4)
+                H_grasp2world = to_homogeneous(grasp2world_pose.position, tf.SO3(grasp2world_pose.wxyz).as_matrix())
+                H_ee2grasp = to_homogeneous(ur52grasp_pose.position, tf.SO3(ur52grasp_pose.wxyz).as_matrix())
+                H_ee2world_candidates = H_grasp2world @ GRASP_TEST_ROTATIONS @ H_ee2grasp
+
                 start = time.time()
                 print("Trying grasp", traj_grasp_ind)
-                for i in range(num_rotations_test):
+                # only plan for the rotations whose approach (z) axis doesn't point up
+                for i in np.flatnonzero(H_ee2world_candidates[:, 2, 2] <= 0):
                     print("Trying rotation", i)
+                    H_ee2world = H_ee2world_candidates[i]
                     grasp_pose = RigidTransform(
-                        translation=grasp2world_pose.position,
-                        rotation=tf.SO3(grasp2world_pose.wxyz).as_matrix(),
-                        from_frame="grasp",
-                        to_frame="world"
-                    ) * RigidTransform(
-                        rotation=RigidTransform.y_axis_rotation(i * (2*np.pi)/num_rotations_test),
-                        from_frame="grasp",
-                        to_frame="grasp"
-                    ) * RigidTransform(
-                        translation=ur52grasp_pose.position,
-                        rotation=tf.SO3(ur52grasp_pose.wxyz).as_matrix(),
+                        translation=H_ee2world[:3, 3],
+                        rotation=H_ee2world[:3, :3],
                         from_frame="grasp/ee",
-                        to_frame="grasp"
+                        to_frame="world"
                     )
-                    if grasp_pose.matrix[:, 2][2] > 0:
-                        continue
-                    
+
                     traj, succ, fin_pose = grasp_planner.create_traj_from_grasp(grasp_pose, world_pointcloud=world_pointcloud)
                     if not succ:
                         print(" - Failed")
@@ -1067,17 +1099,24 @@ def main(
                 gen_traj_button.disabled = False
                 return
 
-            min_dist = np.inf
-            best_traj, best_end_pose = None, None
-            for curr_traj, end_pose in succ_traj_list:
-                dist = np.linalg.norm(curr_traj[0, :] - curr_traj[-1, :])
-                # dist matters, but making sure that the end pose is aligned is very important.
-                if dist < min_dist and ((best_end_pose is None) or (np.linalg.norm(best_end_pose.translation-grasp_pose.translation) > np.linalg.norm(end_pose.translation-grasp_pose.translation))):
-                    min_dist = dist
-                    best_traj = curr_traj
-                    best_end_pose = end_pose
-
-            traj, fin_pose = best_traj, best_end_pose
+            # joint-space distance travelled, and end pose misalignment w.r.t. the grasp, per candidate
+            dists = np.linalg.norm(
+                np.stack([curr_traj[0, :] for curr_traj, _ in succ_traj_list])
+                - np.stack([curr_traj[-1, :] for curr_traj, _ in succ_traj_list]),
+                axis=1
+            )
+            misaligns = np.linalg.norm(
+                np.stack([end_pose.translation for _, end_pose in succ_traj_list]) - grasp_pose.translation,
+                axis=1
+            )
+            # dist matters, but making sure that the end pose is aligned is very important:
+            # a candidate only replaces the current best if it is better at both.
+            best_ind = 0
+            for ind in range(1, len(succ_traj_list)):
+                if dists[ind] < dists[best_ind] and misaligns[ind] < misaligns[best_ind]:
+                    best_ind = ind
+
+            traj, fin_pose = succ_traj_list[best_ind]
             succ = True
 
             traj_up, succ_up = grasp_planner.create_traj_lift_up(